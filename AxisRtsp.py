@@ -15,15 +15,47 @@ import pygst
 pygst.require('0.10')
 import gst
 import gtk
+import gobject
 import datetime
+import os
+import struct
+import threading
+import time
+import RecordingWriter
+import ParallelDecode
+
+# each entry of a recording's timestamp file (recording.avi.ts): timestamp of
+# the frame relative to the first frame (ns) and size of the jpeg image
+TIMESTAMP_ENTRY = struct.Struct('<QI')
 
 class RtspBaseClass:
     '''RtspBaseClass is a base class that provides the building blocks for other
     classes that create rtsp pipelines.  Commonly used gstreamer pipeline 
     elements and callback methods are defined within.'''
     
+    # number of threads used to decode mjpeg; see createDecodeElement:
+    decodeThreads = 1
+    # rtsp port of the camera; see formRtspUri:
+    rtspPort = 554
+    # directory that recordings are written to; see assignOutputFilename:
+    outputDirectory = '.'
+    # a tee is only present while something other than the display needs
+    # the video, e.g. a recording branch; see startRecording:
+    tee = None
+    teeIsDynamic = False
+    recordingBranch = None
+    numberOfRecordingBranches = 0
+    # recording is started again when the pipeline next plays; see
+    # setPipelineStateToNull:
+    restartRecording = False
+
     def createEmptyPipeline(self):
         self.pipeline = gst.Pipeline('mypipeline')
+        # link changes waiting for a pad to block: pad -> [(callback, args)];
+        # see modifyLinksAtPad:
+        self.linkChangeLock = threading.Lock()
+        self.pendingLinkChanges = {}
+        self.blockedLinkChangePads = set()
 
     def createVideobalanceElement(self):
         self.videobalance = gst.element_factory_make('videobalance', \
@@ -49,7 +81,11 @@ class RtspBaseClass:
         self.tee = gst.element_factory_make('tee', 'tee')
 
     def createQueueFileElement(self):
+        '''The file queue is leaky so that, when the disk cannot keep up, old
+        frames are dropped from the recording rather than blocking the tee
+        and hence the display'''
         self.queueFile = gst.element_factory_make('queue', 'queueFile')
+        self.queueFile.set_property('leaky', 2) # 2 = leak downstream (old)
 
     def createQueueDisplayElement(self):
         self.queueDisplay = gst.element_factory_make('queue', 'queueDisplay')
@@ -70,16 +106,356 @@ class RtspBaseClass:
         self.filesink = gst.element_factory_make('filesink', 'filesink')
         self.assignOutputFilename()
 
+    def createRecordingSinkElement(self):
+        '''The recording sink is a fakesink that hands each muxed buffer to a
+        RecordingWriter.  The writer does the disk writes on its own thread so
+        that a slow disk only ever degrades the recording.'''
+        self.recordingSink = gst.element_factory_make('fakesink', \
+            'recordingSink')
+        self.recordingSink.set_property('signal-handoffs', True)
+        self.recordingSink.set_property('sync', False)
+        self.recordingSink.set_property('async', False)
+        self.recordingWriter = RecordingWriter.RecordingWriter()
+        self.recordingSink.connect('handoff', self.onRecordingSinkHandoff, \
+            self.recordingWriter)
+        self.recordingSink.get_pad('sink').add_event_probe(\
+            self.onRecordingSinkEvent, self.recordingWriter, \
+            self.timestampWriter)
+        self.assignOutputFilename()
+
+    def createTimestampWriter(self):
+        '''avi only records a nominal frame rate, so the timestamp and size of
+        every frame going into avimux are written to recording.avi.ts.
+        Playback uses them to place frames in time when frames have been
+        dropped.'''
+        self.timestampWriter = RecordingWriter.RecordingWriter(\
+            maxBufferedBytes=1024*1024, batchSize=64*1024)
+        self.jpegenc.get_pad('src').add_buffer_probe(self.onRecordedFrame, \
+            self.timestampWriter, [])
+
+    def onRecordedFrame(self, pad, buffer, writer, firstTimestamp):
+        '''Writes the timestamp entry of a frame.  firstTimestamp is a list
+        holding the timestamp of the first frame of the recording.'''
+        if buffer.timestamp!=gst.CLOCK_TIME_NONE:
+            if not firstTimestamp:
+                firstTimestamp.append(buffer.timestamp)
+            writer.write(TIMESTAMP_ENTRY.pack(max(0, buffer.timestamp - \
+                firstTimestamp[0]), buffer.size))
+        return True
+
+    def createRecordingBranch(self):
+        '''The recording branch is a bin containing queue ! jpegenc ! avimux !
+        recording sink with a ghost sink pad.  It can be attached to and
+        detached from a running pipeline; see startRecording.  Each branch
+        records to a new file.'''
+        self.numberOfRecordingBranches = self.numberOfRecordingBranches + 1
+        self.recordingBranch = gst.Bin('recordingBranch%d' % \
+            self.numberOfRecordingBranches)
+        self.createQueueFileElement()
+        self.createJpegencElement()
+        self.createAvimuxElement()
+        self.createTimestampWriter()
+        self.createRecordingSinkElement()
+        self.recordingBranch.add(self.queueFile, self.jpegenc, self.avimux, \
+            self.recordingSink)
+        gst.element_link_many(self.queueFile, self.jpegenc, self.avimux, \
+            self.recordingSink)
+        self.recordingBranch.add_pad(gst.GhostPad('sink', \
+            self.queueFile.get_pad('sink')))
+
     def assignOutputFilename(self):
         '''self.outputFilename is of the form 
-        year_month_day_hour_minute_second.avi'''
+        year_month_day_hour_minute_second.avi.  If that file already exists,
+        e.g. because recording was restarted within the same second and the
+        old branch is still finishing it, a number is appended:
+        year_month_day_hour_minute_second_number.avi'''
         now = datetime.datetime.now()
-        outputFilename = \
-            './%s_%s_%s_%s_%s_%s.avi' % (now.year, \
-            str(now.month).zfill(2), str(now.day).zfill(2), \
+        name = os.path.join(self.outputDirectory, '%s_%s_%s_%s_%s_%s' % \
+            (now.year, str(now.month).zfill(2), str(now.day).zfill(2), \
             str(now.hour).zfill(2), str(now.minute).zfill(2), \
-            str(now.second).zfill(2))
-        self.filesink.set_property('location', outputFilename)
+            str(now.second).zfill(2)))
+        self.outputFilename = name + '.avi'
+        number = 1
+        while os.path.exists(self.outputFilename):
+            number = number + 1
+            self.outputFilename = '%s_%d.avi' % (name, number)
+        if hasattr(self, 'recordingWriter'):
+            self.recordingWriter.open(self.outputFilename)
+            self.timestampWriter.open(self.outputFilename + '.ts')
+        else:
+            self.filesink.set_property('location', self.outputFilename)
+
+    def onRecordingSinkHandoff(self, fakesink, buffer, pad, writer):
+        '''Passes muxed data to the writer thread'''
+        writer.write(buffer.data)
+
+    def onRecordingSinkEvent(self, pad, event, writer, timestampWriter):
+        '''Muxers such as avimux rewrite their header at the end of a recording
+        by sending a newsegment event in bytes.  This is the equivalent of a
+        seek in filesink.  At EOS, everything buffered is written out and, if
+        the recording branch has been detached, it is removed from the
+        pipeline.'''
+        if event.type==gst.EVENT_NEWSEGMENT:
+            segment = event.parse_new_segment()
+            if segment[2]==gst.FORMAT_BYTES:
+                writer.seek(segment[3])
+        elif event.type==gst.EVENT_EOS:
+            writer.flush()
+            timestampWriter.flush()
+            branch = pad.get_parent_element().get_parent()
+            if branch is not self.recordingBranch:
+                gobject.idle_add(self.removeRecordingBranch, branch, writer, \
+                    timestampWriter)
+        return True
+
+    def isRecording(self):
+        return self.recordingBranch is not None
+
+    def toggleRecording(self):
+        if self.isRecording():
+            self.stopRecording()
+        else:
+            self.startRecording()
+
+    def startRecording(self):
+        '''Attaches a new recording branch to the pipeline.  Display-only
+        pipelines have no tee, so one is inserted in front of the display sink
+        first.  While the pipeline is playing, the pad feeding the display
+        is blocked for the short time it takes to relink.'''
+        if self.isRecording():
+            return
+        self.createRecordingBranch()
+        print('Recording to %s' % self.outputFilename)
+        self.modifyDisplayFeed(self.attachRecordingBranch, \
+            self.recordingBranch)
+
+    def stopRecording(self):
+        '''Detaches the recording branch.  An EOS is sent down the branch so
+        that avimux finalises the file index; the branch is removed once the
+        EOS reaches the recording sink.  The branch state is locked so that
+        it keeps running until then, whatever the state of the pipeline.  A
+        branch whose attach is still waiting for the display feed to block
+        is dropped instead.'''
+        if not self.isRecording():
+            return
+        branch = self.recordingBranch
+        self.recordingBranch = None
+        self.restartRecording = False
+        if self.cancelLinkChange(self.attachRecordingBranch, branch):
+            print('Recording discarded: %s' % self.outputFilename)
+            self.startClosingRecordingWriters(self.recordingWriter, \
+                self.timestampWriter, True)
+            return
+        branch.set_locked_state(True)
+        self.modifyDisplayFeed(self.detachRecordingBranch, branch)
+
+    def getDisplayFeedPad(self):
+        '''Returns the src pad that feeds the tee or, if there is no tee, the
+        display sink'''
+        if self.tee is not None:
+            return self.tee.get_pad('sink').get_peer()
+        return self.xvimagesink.get_pad('sink').get_peer()
+
+    def modifyDisplayFeed(self, callback, *args):
+        '''Calls callback(*args) with the display feed pad blocked'''
+        self.modifyLinksAtPad(self.getDisplayFeedPad(), callback, *args)
+
+    def dataCanFlow(self):
+        '''Returns True if the pipeline is playing or on its way to paused or
+        playing, i.e. a streaming thread may be pushing data'''
+        (result, state, pending) = self.pipeline.get_state(0)
+        return state==gst.STATE_PLAYING or \
+            pending in (gst.STATE_PAUSED, gst.STATE_PLAYING)
+
+    def modifyLinksAtPad(self, pad, callback, *args):
+        '''Calls callback(*args) with pad blocked if data can flow, or
+        straight away if it cannot.  Everything downstream of pad can be
+        relinked safely from callback.  A pad that is already flagged blocked
+        ignores another block request, so callbacks for the same pad are
+        queued and run one after another while it is blocked.'''
+        self.linkChangeLock.acquire()
+        try:
+            if pad in self.pendingLinkChanges:
+                self.pendingLinkChanges[pad].append((callback, args))
+                return
+            if self.dataCanFlow():
+                self.pendingLinkChanges[pad] = [(callback, args)]
+                pad.set_blocked_async(True, self.onLinkChangePadBlocked)
+                return
+        finally:
+            self.linkChangeLock.release()
+        callback(*args)
+
+    def onLinkChangePadBlocked(self, pad, isBlocked):
+        '''Runs the queued callbacks of pad, including any queued while they
+        run, then unblocks it.  Callbacks queued after that block the pad
+        again.'''
+        if not isBlocked:
+            return
+        self.linkChangeLock.acquire()
+        self.blockedLinkChangePads.add(pad)
+        self.linkChangeLock.release()
+        self.runLinkChanges(pad)
+        pad.set_blocked_async(False, lambda pad, isBlocked: None)
+        self.linkChangeLock.acquire()
+        self.blockedLinkChangePads.discard(pad)
+        blockAgain = bool(self.pendingLinkChanges.get(pad))
+        if not blockAgain:
+            self.pendingLinkChanges.pop(pad, None)
+        self.linkChangeLock.release()
+        if blockAgain:
+            pad.set_blocked_async(True, self.onLinkChangePadBlocked)
+
+    def runLinkChanges(self, pad):
+        while True:
+            self.linkChangeLock.acquire()
+            try:
+                callbacks = self.pendingLinkChanges.get(pad)
+                if not callbacks:
+                    return
+                (callback, args) = callbacks.pop(0)
+            finally:
+                self.linkChangeLock.release()
+            callback(*args)
+
+    def cancelLinkChange(self, callback, *args):
+        '''Removes callback(*args) from the queues of modifyLinksAtPad if it
+        has not run yet and returns True if it was there.  A pad left with
+        nothing to do that has not blocked yet is unblocked.'''
+        unblockPad = None
+        self.linkChangeLock.acquire()
+        try:
+            for (pad, callbacks) in list(self.pendingLinkChanges.items()):
+                if (callback, args) in callbacks:
+                    callbacks.remove((callback, args))
+                    if not callbacks and pad not in self.blockedLinkChangePads:
+                        del self.pendingLinkChanges[pad]
+                        unblockPad = pad
+                    break
+            else:
+                return False
+        finally:
+            self.linkChangeLock.release()
+        if unblockPad is not None:
+            unblockPad.set_blocked_async(False, lambda pad, isBlocked: None)
+        return True
+
+    def runPendingLinkChanges(self):
+        '''Runs link changes whose pad never blocked because data stopped
+        flowing first.  Only call this when no data can flow.'''
+        self.linkChangeLock.acquire()
+        pads = list(self.pendingLinkChanges.keys())
+        self.linkChangeLock.release()
+        for pad in pads:
+            pad.set_blocked_async(False, lambda pad, isBlocked: None)
+            self.runLinkChanges(pad)
+            self.linkChangeLock.acquire()
+            self.pendingLinkChanges.pop(pad, None)
+            self.linkChangeLock.release()
+
+    def attachRecordingBranch(self, branch):
+        '''Links a tee src pad to branch, inserting the tee if there is none.
+        Runs with the display feed blocked.'''
+        if self.tee is None:
+            feedPad = self.getDisplayFeedPad()
+            displayPad = self.xvimagesink.get_pad('sink')
+            self.createTeeElement()
+            self.teeIsDynamic = True
+            self.pipeline.add(self.tee)
+            self.tee.sync_state_with_parent()
+            feedPad.unlink(displayPad)
+            feedPad.link(self.tee.get_pad('sink'))
+            self.tee.get_request_pad('src%d').link(displayPad)
+        self.pipeline.add(branch)
+        branch.sync_state_with_parent()
+        # the branch missed the newsegment that started the stream:
+        branch.get_pad('sink').send_event(gst.event_new_new_segment(False, \
+            1.0, gst.FORMAT_TIME, 0, -1, 0))
+        self.tee.get_request_pad('src%d').link(branch.get_pad('sink'))
+
+    def detachRecordingBranch(self, branch):
+        '''Unlinks branch from the tee and sends it EOS.  A tee that was
+        inserted by attachRecordingBranch is removed again so that the
+        display-only pipeline is restored.  Runs with the display feed
+        blocked.'''
+        branchPad = branch.get_pad('sink')
+        teePad = branchPad.get_peer()
+        teePad.unlink(branchPad)
+        self.tee.release_request_pad(teePad)
+        if self.teeIsDynamic:
+            feedPad = self.getDisplayFeedPad()
+            displayPad = self.xvimagesink.get_pad('sink')
+            teePad = displayPad.get_peer()
+            feedPad.unlink(self.tee.get_pad('sink'))
+            teePad.unlink(displayPad)
+            self.tee.release_request_pad(teePad)
+            feedPad.link(displayPad)
+            self.tee.set_state(gst.STATE_NULL)
+            self.pipeline.remove(self.tee)
+            self.tee = None
+            self.teeIsDynamic = False
+        # the branch is locked, so it is started here if the pipeline is
+        # paused or stopped:
+        branch.set_state(gst.STATE_PLAYING)
+        branchPad.send_event(gst.event_new_eos())
+
+    def removeRecordingBranch(self, branch, writer, timestampWriter):
+        '''Shuts down a detached recording branch.  Its files are closed on a
+        thread of their own because draining the writers to a slow (or dead)
+        disk can take a long time and must not hold up the main loop.'''
+        branch.set_state(gst.STATE_NULL)
+        self.pipeline.remove(branch)
+        self.startClosingRecordingWriters(writer, timestampWriter)
+        return False
+
+    def startClosingRecordingWriters(self, writer, timestampWriter, \
+        delete=False):
+        thread = threading.Thread(target=self.closeRecordingWriters, \
+            args=(writer, timestampWriter, delete), name='closeRecording')
+        thread.daemon = True
+        thread.start()
+
+    def closeRecordingWriters(self, writer, timestampWriter, delete=False):
+        '''Closes the files of a recording.  If delete is True the recording
+        was never attached, so its (empty) files are deleted.'''
+        writer.close()
+        timestampWriter.close()
+        if delete:
+            for location in (writer.location, timestampWriter.location):
+                try:
+                    os.remove(location)
+                except OSError:
+                    pass
+            return
+        statistics = writer.getStatistics()
+        print('Recording stopped: %s (%d bytes written at %.1f MB/s, ' \
+            '%.1f MB/s in os.write, %d bytes dropped, buffer high water %d ' \
+            'bytes)' % (statistics['location'], statistics['bytesWritten'], \
+            statistics['averageThroughput'] / 1e6, \
+            statistics['writeThroughput'] / 1e6, statistics['bytesDropped'], \
+            statistics['bufferHighWater']))
+
+    def waitForRecordingsToFinish(self, timeout=5.0):
+        '''Runs the main loop until every recording that has been stopped is
+        finalised and its files are closed, or until timeout seconds have
+        passed.  Returns True if they all were.'''
+        deadline = time.time() + timeout
+        while RecordingWriter.getOpenLocations():
+            if time.time() > deadline:
+                return False
+            if gtk.events_pending():
+                gtk.main_iteration(False)
+            else:
+                time.sleep(0.01)
+        return True
+
+    def getRecordingStatistics(self):
+        '''Returns write throughput and buffer high water mark of the recording
+        writer, or None if the pipeline does not record'''
+        try:
+            return self.recordingWriter.getStatistics()
+        except AttributeError:
+            return None
 
     def createRtspsrcElement(self):
         '''The name of each rtsp source element is a string representing its
@@ -99,16 +475,22 @@ class RtspBaseClass:
     def formRtspUri(self):
         '''The rtsp stream can be accessed via this string on Axis cameras:'''
         self.rtspUri = \
-            'rtsp://%s:554/axis-media/media.amp?videocodec=jpeg&audio=0' %\
-            (self.ipAddress)
+            'rtsp://%s:%d/axis-media/media.amp?videocodec=jpeg&audio=0' %\
+            (self.ipAddress, self.rtspPort)
 
     def createDepayElement(self):
         '''creates jpeg depayer element'''
         self.depay = gst.element_factory_make('rtpjpegdepay','mydepay')
         
     def createDecodeElement(self):
-        '''creates mjpeg decoder element'''
-        self.decode = gst.element_factory_make('ffdec_mjpeg','mydecode')
+        '''creates mjpeg decoder element.  If more than one decode thread is
+        requested, a ParallelMjpegDecoder decodes frames on several threads
+        at once.'''
+        if self.decodeThreads > 1:
+            self.decode = ParallelDecode.ParallelMjpegDecoder(\
+                self.decodeThreads, 'mydecode')
+        else:
+            self.decode = gst.element_factory_make('ffdec_mjpeg','mydecode')
 
     def createCropElement(self):
         self.crop = gst.element_factory_make('videocrop','mycropper')
@@ -156,13 +538,24 @@ class RtspBaseClass:
             self.setPipelineStateToPaused()
     
     def setPipelineStateToPlaying(self):
+        '''If the pipeline was recording when it was last set to null,
+        recording starts again in a new file'''
+        if self.restartRecording:
+            self.restartRecording = False
+            self.startRecording()
         self.pipeline.set_state(gst.STATE_PLAYING)
 
     def setPipelineStateToPaused(self):
         self.pipeline.set_state(gst.STATE_PAUSED)
 
     def setPipelineStateToNull(self):
+        '''A recording in progress is stopped first so that its file is
+        finalised by the detached branch'''
+        restartRecording = self.restartRecording or self.isRecording()
+        self.stopRecording()
+        self.restartRecording = restartRecording
         self.pipeline.set_state(gst.STATE_NULL)
+        self.runPendingLinkChanges()
 
     def setCurrentCropProperties(self, left, right, top, bottom):
         '''Sets borders for the videocrop element'''
@@ -173,6 +566,13 @@ class RtspBaseClass:
             self.crop.set_property('bottom', bottom)
         except:
             print('Cannot set crop properties.  Check videocrop element exists')
+
+    def setBrightness(self, brightness):
+        '''Sets brightness of the videobalance element'''
+        try:
+            self.videobalance.set_property('brightness', brightness)
+        except:
+            print('Cannot set brightness.  Maybe no videobalance element')
  
 class RtspPipelineToDisplay(RtspBaseClass):
     '''This class creates and rtsp pipeline that takes displays an rtsp stream
@@ -181,10 +581,11 @@ class RtspPipelineToDisplay(RtspBaseClass):
     The Gstreamer pipeline elements are inherited from the RtspBaseClass 
     class.'''
     
-    def __init__(self, ipAddress, xid):
+    def __init__(self, ipAddress, xid, decodeThreads=1):
         self.ipAddress = ipAddress
         # xid is the xwindow I.D. where the video stream will be displayed:
         self.xid = xid
+        self.decodeThreads = decodeThreads
         self.createGstreamerPipeline()
         
     def createGstreamerPipeline(self):
@@ -239,12 +640,15 @@ class RtspPipelineToDisplay(RtspBaseClass):
 class RtspPipelineToFileAndDisplay(RtspBaseClass):
     '''This class writes an rtsp stream to file and symultaneously displays the
     stream to an xvimagesink.  It is similar to the RtspPipelineToDisplay class
-    with the addition of recording to file.'''
+    with the addition of recording to file.  The recording branch is attached
+    when the pipeline is created and can be stopped and restarted with
+    toggleRecording.'''
     
-    def __init__(self, ipAddress, xid):
+    def __init__(self, ipAddress, xid, decodeThreads=1):
         self.ipAddress = ipAddress
         # xid is the xwindow I.D. where the video stream will be displayed:
         self.xid = xid
+        self.decodeThreads = decodeThreads
         self.createGstreamerPipeline()
         
     def createGstreamerPipeline(self):
@@ -258,9 +662,11 @@ class RtspPipelineToFileAndDisplay(RtspBaseClass):
         self.addElementsToPipeline()
         self.linkPipelineElements()
         self.createPipelineCallbacks()
+        self.startRecording()
     
     def createPipelineElements(self):
-        '''Create the elements required for the pipeline'''
+        '''Create the elements required for the pipeline.  The recording
+        elements are created by startRecording.'''
         self.createRtspsrcElement()
         self.createDepayElement()
         self.createDecodeElement()
@@ -271,13 +677,7 @@ class RtspPipelineToFileAndDisplay(RtspBaseClass):
         self.createCapsfilterElement()
         self.createFfmpegcolorspaceElement()
         self.createTeeElement()
-        self.createQueueFileElement()
         self.createQueueDisplayElement()
-#        self.createTheoraencElement()
-#        self.createOggmuxElement()
-        self.createJpegencElement()
-        self.createAvimuxElement()
-        self.createFilesinkElement()
         self.createXvimagesinkElement()
 
     def addElementsToPipeline(self):
@@ -292,13 +692,7 @@ class RtspPipelineToFileAndDisplay(RtspBaseClass):
         self.pipeline.add(self.capsfilter)
         self.pipeline.add(self.ffmpegcolorspace)
         self.pipeline.add(self.tee)
-        self.pipeline.add(self.queueFile)
         self.pipeline.add(self.queueDisplay)
-#        self.pipeline.add(self.theoraenc)
-#        self.pipeline.add(self.oggmux)
-        self.pipeline.add(self.jpegenc)
-        self.pipeline.add(self.avimux)
-        self.pipeline.add(self.filesink)
         self.pipeline.add(self.xvimagesink)
 
     def linkPipelineElements(self):
@@ -312,13 +706,6 @@ class RtspPipelineToFileAndDisplay(RtspBaseClass):
         self.videobalance.link(self.capsfilter)
         self.capsfilter.link(self.ffmpegcolorspace)
         self.ffmpegcolorspace.link(self.tee)
-        self.tee.link(self.queueFile)
-#        self.queueFile.link(self.theoraenc)
-#        self.theoraenc.link(self.oggmux)
-#        self.oggmux.link(self.filesink)
-        self.queueFile.link(self.jpegenc)
-        self.jpegenc.link(self.avimux)
-        self.avimux.link(self.filesink)
         self.tee.link(self.queueDisplay)
         self.queueDisplay.link(self.xvimagesink)
 
@@ -326,10 +713,11 @@ class RtspPipelineLightenOnly(RtspBaseClass):
     '''This class displays an rtsp stream to the screen with brightness
     adjustment and no PTZ functions'''
     
-    def __init__(self, ipAddress, xid):
+    def __init__(self, ipAddress, xid, decodeThreads=1):
         self.ipAddress = ipAddress
         # xid is the xwindow I.D. where the video stream will be displayed:
         self.xid = xid
+        self.decodeThreads = decodeThreads
         self.createGstreamerPipeline()
         
     def createGstreamerPipeline(self):
@@ -371,10 +759,11 @@ class RtspPipelineSimple(RtspBaseClass):
     '''This class displays an rtsp stream to the screen with no PTZ or 
     brightness adjustment'''
     
-    def __init__(self, ipAddress, xid):
+    def __init__(self, ipAddress, xid, decodeThreads=1):
         self.ipAddress = ipAddress
         # xid is the xwindow I.D. where the video stream will be displayed:
         self.xid = xid
+        self.decodeThreads = decodeThreads
         self.createGstreamerPipeline()
         
     def createGstreamerPipeline(self):
@@ -408,3 +797,234 @@ class RtspPipelineSimple(RtspBaseClass):
         source pad'''
         self.depay.link(self.decode)
         self.decode.link(self.xvimagesink)
+
+class RtspPipelineBuilder(RtspBaseClass):
+    '''This class builds a display pipeline from the features requested
+    instead of a fixed chain of elements.  Between the decoder and the
+    display sink there are up to four stages, in this order:
+
+        crop:       videocrop (feature crop)
+        scale:      videoscale ! videorate ! capsfilter (feature scale)
+        balance:    videobalance (feature balance)
+        colorspace: ffmpegcolorspace (always available)
+
+    A stage is only linked into the pipeline while it does something.  Crop
+    and scale are switched in the first time a crop border is set, balance
+    the first time the brightness is changed from 0.0, and colorspace is
+    switched out once the decoded format turns out to be one that the
+    xvimagesink accepts directly.  So a pipeline built with crop, scale and
+    balance (the 'lightenPTZ' mode) costs the same as RtspPipelineSimple
+    until PTZ or lightening is used.  Crop, scale and balance stay in once
+    they have been switched in.  Colorspace is switched back in when the
+    pipeline is set to null, because the next stream may need converting.
+
+    record=True attaches a recording branch when the pipeline is built; see
+    RtspBaseClass.startRecording.  taps is a dictionary of buffer probe
+    callbacks keyed by 'decode' (decoder output) or 'display' (display sink
+    input).  The stages that are active are printed whenever they change
+    and returned by getActiveStages.'''
+
+    stageOrder = ['crop', 'scale', 'balance', 'colorspace']
+
+    def __init__(self, ipAddress, xid, decodeThreads=1, crop=False, \
+        scale=False, balance=False, record=False, taps=None):
+        self.ipAddress = ipAddress
+        # xid is the xwindow I.D. where the video stream will be displayed:
+        self.xid = xid
+        self.decodeThreads = decodeThreads
+        self.features = {'crop': crop, 'scale': scale, 'balance': balance, \
+            'colorspace': True}
+        self.record = record
+        self.taps = taps or {}
+        self.createGstreamerPipeline()
+
+    def createGstreamerPipeline(self):
+        '''This pipeline implements something similar to the following bash
+        equivalent in Python: gst-launch-0.10 -vvv rtspsrc 
+        location='rtsp://192.168.1.60:554/axis-media/
+        media.amp?videocodec=jpeg&audio=0' ! rtpjpegdepay ! ffdec_mjpeg ! ...
+        ! xvimagesink where ... is the active stages'''
+        self.createEmptyPipeline()
+        self.createPipelineElements()
+        self.addElementsToPipeline()
+        self.linkPipelineElements()
+        self.createPipelineCallbacks()
+        self.createTaps()
+        if self.record:
+            self.startRecording()
+        self.reportActiveStages()
+
+    def createPipelineElements(self):
+        '''Creates the elements of every stage requested, whether or not the
+        stage starts off active'''
+        self.createRtspsrcElement()
+        self.createDepayElement()
+        self.createDecodeElement()
+        self.createXvimagesinkElement()
+        self.stages = {}
+        if self.features['crop']:
+            self.createCropElement()
+            self.stages['crop'] = [self.crop]
+        if self.features['scale']:
+            self.createVideoscaleElement()
+            self.createVideorateElement()
+            self.createCapsfilterElement()
+            self.stages['scale'] = [self.videoscale, self.videorate, \
+                self.capsfilter]
+        if self.features['balance']:
+            self.createVideobalanceElement()
+            self.stages['balance'] = [self.videobalance]
+        self.createFfmpegcolorspaceElement()
+        self.stages['colorspace'] = [self.ffmpegcolorspace]
+        self.ffmpegcolorspace.get_pad('sink').connect('notify::caps', \
+            self.onColorspaceCaps)
+        self.activeStages = ['colorspace']
+        # wantedStages and relinkPending are shared with streaming threads:
+        self.stageLock = threading.Lock()
+        self.wantedStages = set(self.activeStages)
+        self.relinkPending = False
+
+    def addElementsToPipeline(self):
+        '''Add the elements of the active stages to the pipeline'''
+        self.pipeline.add(self.source)
+        self.pipeline.add(self.depay)
+        self.pipeline.add(self.decode)
+        for element in self.getStageElements(self.activeStages):
+            self.pipeline.add(element)
+        self.pipeline.add(self.xvimagesink)
+
+    def linkPipelineElements(self):
+        '''Link all elements in pipeline except source which has a dynamic
+        source pad'''
+        self.depay.link(self.decode)
+        gst.element_link_many(self.decode, \
+            *(self.getStageElements(self.activeStages) + [self.xvimagesink]))
+
+    def createTaps(self):
+        pads = {'decode': self.decode.get_pad('src'), \
+            'display': self.xvimagesink.get_pad('sink')}
+        for (point, callback) in self.taps.items():
+            pads[point].add_buffer_probe(callback)
+
+    def getStageElements(self, stageNames):
+        elements = []
+        for name in stageNames:
+            elements.extend(self.stages[name])
+        return elements
+
+    def getActiveStages(self):
+        '''Returns the names of the elements that video currently passes
+        through'''
+        elements = [self.source, self.depay, self.decode] + \
+            self.getStageElements(self.activeStages)
+        names = [element.get_name() for element in elements]
+        if self.isRecording():
+            names.append('tee (recording)')
+        return names + [self.xvimagesink.get_name()]
+
+    def reportActiveStages(self):
+        print('Active stages: %s' % ' ! '.join(self.getActiveStages()))
+
+    def switchStagesIn(self, *stageNames):
+        self.stageLock.acquire()
+        self.wantedStages.update([name for name in stageNames if \
+            name in self.stages])
+        self.stageLock.release()
+        self.applyWantedStages()
+
+    def switchStagesOut(self, *stageNames):
+        self.stageLock.acquire()
+        self.wantedStages.difference_update(stageNames)
+        self.stageLock.release()
+        self.applyWantedStages()
+
+    def applyWantedStages(self):
+        '''Relinks the pipeline if the wanted stages differ from the active
+        ones.  If data can flow, the decoder output is blocked while
+        relinking so no data is inside the stages.  Changes made while a
+        relink is pending are picked up once it has finished.'''
+        self.stageLock.acquire()
+        try:
+            if self.relinkPending or \
+                self.wantedStages==set(self.activeStages):
+                return
+            self.relinkPending = True
+        finally:
+            self.stageLock.release()
+        self.modifyLinksAtPad(self.decode.get_pad('src'), self.relinkStages)
+
+    def modifyDisplayFeed(self, callback, *args):
+        '''The pad feeding the display changes as stages are switched in and
+        out, so recording branches are attached and detached with the decoder
+        output blocked instead, in turn with relinks of the stages'''
+        self.modifyLinksAtPad(self.decode.get_pad('src'), callback, *args)
+
+    def relinkStages(self):
+        '''Unlinks the chain from the decoder to the tee (or display sink),
+        removes stages that are no longer wanted, adds new ones and links the
+        chain again in stageOrder'''
+        self.stageLock.acquire()
+        wanted = [name for name in self.stageOrder if \
+            name in self.wantedStages]
+        self.stageLock.release()
+        tail = self.tee or self.xvimagesink
+        chain = [self.decode] + self.getStageElements(self.activeStages) + \
+            [tail]
+        for i in range(len(chain) - 1):
+            chain[i].unlink(chain[i + 1])
+        for name in self.activeStages:
+            if name not in wanted:
+                for element in self.stages[name]:
+                    element.set_state(gst.STATE_NULL)
+                    self.pipeline.remove(element)
+        added = []
+        for name in wanted:
+            if name not in self.activeStages:
+                added.extend(self.stages[name])
+        for element in added:
+            self.pipeline.add(element)
+        gst.element_link_many(self.decode, \
+            *(self.getStageElements(wanted) + [tail]))
+        for element in added:
+            element.sync_state_with_parent()
+        self.activeStages = wanted
+        self.reportActiveStages()
+        self.stageLock.acquire()
+        self.relinkPending = False
+        self.stageLock.release()
+        # picks up changes made while relinking; the decoder output is still
+        # blocked so the next relink runs straight after this one:
+        self.applyWantedStages()
+
+    def onColorspaceCaps(self, pad, parameter):
+        '''Called on the streaming thread that is pushing through
+        ffmpegcolorspace, so it cannot be switched out from here.  The check
+        is made from the main loop instead.'''
+        gobject.idle_add(self.switchColorspaceOutIfUnneeded)
+
+    def switchColorspaceOutIfUnneeded(self):
+        '''Switches ffmpegcolorspace out if the display sink accepts the
+        format reaching it as it is'''
+        caps = self.ffmpegcolorspace.get_pad('sink').get_negotiated_caps()
+        displayCaps = self.xvimagesink.get_pad('sink').get_caps()
+        if caps is not None and not caps.intersect(displayCaps).is_empty():
+            self.switchStagesOut('colorspace')
+        return False
+
+    def setCurrentCropProperties(self, left, right, top, bottom):
+        '''Switches in the crop and scale stages when a border is first set'''
+        if left or right or top or bottom:
+            self.switchStagesIn('crop', 'scale')
+        RtspBaseClass.setCurrentCropProperties(self, left, right, top, bottom)
+
+    def setBrightness(self, brightness):
+        '''Switches in the balance stage when brightness first moves from 0'''
+        if brightness!=0.0:
+            self.switchStagesIn('balance')
+        RtspBaseClass.setBrightness(self, brightness)
+
+    def setPipelineStateToNull(self):
+        '''The next stream, e.g. from another camera, may be in a format that
+        needs converting, so colorspace is switched back in'''
+        RtspBaseClass.setPipelineStateToNull(self)
+        self.switchStagesIn('colorspace')
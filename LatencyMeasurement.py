@@ -0,0 +1,304 @@
+#!/usr/bin/python
+
+'''This program measures the capture-to-display latency of the AxisRtsp
+pipeline classes.  A synthetic camera draws the time at which each frame is
+sent into the top of the image as a barcode, encodes the frame as mjpeg and
+serves it over RTSP on localhost at the same path as an Axis camera.  A probe
+on the sink pad of the xvimagesink reads the barcode back from every frame
+that is about to be displayed.  The sink then waits on the clock until the
+frame is due, so that wait is added.  The latency measured includes jpeg
+encoding, RTP/RTSP transport, the jitterbuffer, depayloading, decoding and
+all processing in the pipeline, but not the camera sensor or the screen
+refresh.
+
+Latency histograms are printed for each combination of pipeline class,
+resolution and setting.  Settings are dictionaries whose keys are either
+'decodeThreads' or 'element.property' where element is an attribute of the
+pipeline, e.g. {'source.latency': 200} sets the rtspsrc jitterbuffer latency
+and {'queueDisplay.max-size-buffers': 1} configures the display queue of
+RtspPipelineToFileAndDisplay.  Recordings made while measuring are written to
+a temporary directory that is removed afterwards.
+
+The synthetic camera needs the gst-rtsp-server python bindings
+(python-gst0.10-rtsp).
+
+Usage: python LatencyMeasurement.py [secondsPerMeasurement]'''
+
+__author__ = 'Paul Milliken'
+__licence__ = 'GPLv3'
+__version__ = 0.1
+__maintainer__ = 'Paul Milliken'
+__email__ = 'paul.milliken@gmail.com'
+__status__ = 'Prototype'
+
+import shutil
+import sys
+import tempfile
+import time
+import pygst
+pygst.require('0.10')
+import gobject
+gobject.threads_init()
+import gst
+from gst import rtspserver
+import gtk
+import AxisRtsp
+import Statistics
+
+# The barcode is a band across the top eighth of the image divided into
+# columns: a white guard column, 64 bits of time in microseconds (most
+# significant first, white for 1) and a black guard column.  Positions are
+# relative to the image size so the barcode survives scaling.
+BARCODE_BITS = 64
+BARCODE_COLUMNS = BARCODE_BITS + 2
+WHITE = 235
+BLACK = 16
+GREY = 128
+
+def encodeBarcode(frame, width, height, value):
+    '''Draws value into the luma plane at the start of an I420 frame (a
+    bytearray).  width should be a multiple of 8 so that there is no row
+    padding.'''
+    bits = [1] + [(value >> (BARCODE_BITS - 1 - i)) & 1 for i in \
+        range(BARCODE_BITS)] + [0]
+    row = bytearray(width)
+    for (column, bit) in enumerate(bits):
+        start = column * width // BARCODE_COLUMNS
+        end = (column + 1) * width // BARCODE_COLUMNS
+        row[start:end] = bytearray([bit and WHITE or BLACK]) * (end - start)
+    bandHeight = height // 8
+    frame[0:width * bandHeight] = row * bandHeight
+
+def decodeBarcode(data, fourcc, width, height):
+    '''Reads the barcode from a raw video frame.  Returns the value or None
+    if the format is not supported or the guard columns are wrong.'''
+    if fourcc in ('I420', 'YV12'):
+        (stride, step, first) = ((width + 3) & ~3, 1, 0)
+    elif fourcc in ('YUY2', 'YUYV'):
+        (stride, step, first) = ((2 * width + 3) & ~3, 2, 0)
+    elif fourcc=='UYVY':
+        (stride, step, first) = ((2 * width + 3) & ~3, 2, 1)
+    else:
+        return None
+    rowStart = (height // 16) * stride
+    bits = []
+    for column in range(BARCODE_COLUMNS):
+        x = (2 * column + 1) * width // (2 * BARCODE_COLUMNS)
+        luma = bytearray(data[rowStart + x * step + first:\
+            rowStart + x * step + first + 1])[0]
+        bits.append(luma > GREY and 1 or 0)
+    if bits[0]!=1 or bits[-1]!=0:
+        return None
+    value = 0
+    for bit in bits[1:-1]:
+        value = (value << 1) | bit
+    return value
+
+def createRtspServer(rtspPort, udpPort):
+    '''Serves rtsp://127.0.0.1:rtspPort/axis-media/media.amp by relaying the
+    RTP packets that a SyntheticCamera sends to udpPort'''
+    server = rtspserver.Server()
+    server.set_service(str(rtspPort))
+    factory = rtspserver.MediaFactory()
+    factory.set_launch('( udpsrc port=%d caps="application/x-rtp,' \
+        'media=(string)video,clock-rate=(int)90000,' \
+        'encoding-name=(string)JPEG,payload=(int)96" ! rtpjpegdepay ! ' \
+        'rtpjpegpay name=pay0 pt=96 )' % udpPort)
+    factory.set_shared(True)
+    server.get_media_mapping().add_factory('/axis-media/media.amp', factory)
+    server.attach()
+    return server
+
+class SyntheticCamera:
+    '''Makes timestamped frames in an appsrc pipeline, encodes them as mjpeg
+    and sends them as RTP over udp to the server from createRtspServer'''
+
+    def __init__(self, width, height, framerate=10, udpPort=5600):
+        self.width = width
+        self.height = height
+        self.framerate = framerate
+        self.udpPort = udpPort
+        self.timer = None
+        self.createFrameTemplate()
+        self.createSourcePipeline()
+
+    def createFrameTemplate(self):
+        '''A grey I420 frame'''
+        size = self.width * self.height
+        self.frameTemplate = bytearray([GREY]) * (size + size // 2)
+
+    def createSourcePipeline(self):
+        caps = 'video/x-raw-yuv,format=(fourcc)I420,width=%d,height=%d,' \
+            'framerate=%d/1' % (self.width, self.height, self.framerate)
+        self.pipeline = gst.parse_launch('appsrc name=source is-live=true ' \
+            'do-timestamp=true format=time caps="%s" ! jpegenc ! ' \
+            'rtpjpegpay ! udpsink host=127.0.0.1 port=%d sync=false' % \
+            (caps, self.udpPort))
+        self.source = self.pipeline.get_by_name('source')
+
+    def start(self):
+        self.pipeline.set_state(gst.STATE_PLAYING)
+        self.timer = gobject.timeout_add(1000 // self.framerate, \
+            self.pushFrame)
+
+    def stop(self):
+        gobject.source_remove(self.timer)
+        self.pipeline.set_state(gst.STATE_NULL)
+
+    def pushFrame(self):
+        '''Stamps the send time on a frame and pushes it'''
+        frame = bytearray(self.frameTemplate)
+        encodeBarcode(frame, self.width, self.height, \
+            int(time.time() * 1000000))
+        self.source.emit('push-buffer', gst.Buffer(bytes(frame)))
+        return True
+
+class LatencyProbe:
+    '''A buffer probe on the sink pad of the display sink that records the
+    latency (in milliseconds) of every frame whose barcode can be read.  The
+    probe runs before a synchronised sink waits on the clock, so the time
+    the sink will still wait, i.e. the running time of the frame plus the
+    pipeline latency less the current running time, is added to each
+    sample.'''
+
+    def __init__(self, sink, pipeline):
+        self.sink = sink
+        self.pipeline = pipeline
+        self.latencies = []
+        self.unreadableFrames = 0
+        self.segmentStart = 0
+        self.pipelineLatency = None
+        sink.get_pad('sink').add_buffer_probe(self.onBuffer)
+        sink.get_pad('sink').add_event_probe(self.onEvent)
+
+    def onEvent(self, pad, event):
+        if event.type==gst.EVENT_NEWSEGMENT:
+            segment = event.parse_new_segment()
+            if segment[2]==gst.FORMAT_TIME:
+                self.segmentStart = segment[3]
+        return True
+
+    def getSinkWait(self, buffer):
+        '''Returns the time (in milliseconds) that the sink will wait before
+        rendering buffer'''
+        clock = self.sink.get_clock()
+        if clock is None or not self.sink.get_property('sync') or \
+            buffer.timestamp==gst.CLOCK_TIME_NONE:
+            return 0.0
+        if self.pipelineLatency is None:
+            query = gst.query_new_latency()
+            if not self.pipeline.query(query):
+                return 0.0
+            self.pipelineLatency = query.parse_latency()[1]
+        runningTime = clock.get_time() - self.sink.get_base_time()
+        return max(0, buffer.timestamp - self.segmentStart + \
+            self.pipelineLatency - runningTime) / 1000000.0
+
+    def onBuffer(self, pad, buffer):
+        now = time.time()
+        structure = buffer.get_caps()[0]
+        try:
+            fourcc = structure['format'].fourcc
+        except KeyError:
+            fourcc = None
+        sent = decodeBarcode(buffer.data, fourcc, structure['width'], \
+            structure['height'])
+        if sent is None:
+            self.unreadableFrames = self.unreadableFrames + 1
+        else:
+            self.latencies.append(now * 1000 - sent / 1000.0 + \
+                self.getSinkWait(buffer))
+        return True
+
+def measure(pipelineClass, width, height, settings, seconds, xid, \
+    outputDirectory, rtspPort=8554, udpPort=5600, warmUpFrames=10):
+    '''Runs a synthetic camera into pipelineClass for the given number of
+    seconds and returns a list of latencies in milliseconds.  Pipelines that
+    record do so into outputDirectory.  The rtsp server from
+    createRtspServer must already be running.'''
+    camera = SyntheticCamera(width, height, udpPort=udpPort)
+    class MeasuredPipeline(pipelineClass):
+        pass
+    MeasuredPipeline.rtspPort = rtspPort
+    MeasuredPipeline.outputDirectory = outputDirectory
+    rtspPipeline = MeasuredPipeline('127.0.0.1', xid, \
+        settings.get('decodeThreads', 1))
+    for (key, value) in settings.items():
+        if '.' in key:
+            (element, property) = key.split('.', 1)
+            getattr(rtspPipeline, element).set_property(property, value)
+    probe = LatencyProbe(rtspPipeline.xvimagesink, rtspPipeline.pipeline)
+    camera.start()
+    rtspPipeline.setPipelineStateToPlaying()
+    gobject.timeout_add(int(seconds * 1000), gtk.main_quit)
+    gtk.main()
+    rtspPipeline.setPipelineStateToNull()
+    camera.stop()
+    # a recording branch is removed, and its files closed, from the main
+    # loop; that must be done before the next measurement starts or the
+    # output directory is removed:
+    if not rtspPipeline.waitForRecordingsToFinish():
+        print('Recording was not finalised')
+    while gtk.events_pending():
+        gtk.main_iteration()
+    if probe.unreadableFrames:
+        print('%d frames had no readable barcode' % probe.unreadableFrames)
+    return probe.latencies[warmUpFrames:]
+
+def printHistogram(latencies, binWidth=5.0, barWidth=50):
+    '''Prints a text histogram of latencies in milliseconds'''
+    if not latencies:
+        print('  no frames measured')
+        return
+    bins = {}
+    for latency in latencies:
+        bin = int(latency // binWidth)
+        bins[bin] = bins.get(bin, 0) + 1
+    largest = max(bins.values())
+    for bin in range(min(bins), max(bins) + 1):
+        count = bins.get(bin, 0)
+        print('  %6.0f-%-6.0f ms %5d %s' % (bin * binWidth, \
+            (bin + 1) * binWidth, count, '#' * (count * barWidth // largest)))
+    print('  n=%d min=%.1f median=%.1f 95%%=%.1f max=%.1f ms' % \
+        (len(latencies), min(latencies), \
+        Statistics.percentile(latencies, 0.5), \
+        Statistics.percentile(latencies, 0.95), max(latencies)))
+
+def main():
+    seconds = 10
+    if len(sys.argv) > 1:
+        seconds = float(sys.argv[1])
+    pipelineClasses = [AxisRtsp.RtspPipelineSimple, \
+        AxisRtsp.RtspPipelineLightenOnly, AxisRtsp.RtspPipelineToDisplay, \
+        AxisRtsp.RtspPipelineToFileAndDisplay]
+    resolutions = [(640, 480), (1024, 768), (1600, 1200)]
+    settingsList = [{'source.latency': 0}, {'source.latency': 100}, \
+        {'source.latency': 0, 'decodeThreads': 2}]
+    window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+    drawingArea = gtk.DrawingArea()
+    drawingArea.set_size_request(800, 600)
+    window.add(drawingArea)
+    window.show_all()
+    server = createRtspServer(8554, 5600)
+    outputDirectory = tempfile.mkdtemp(prefix='LatencyMeasurement')
+    summary = []
+    for pipelineClass in pipelineClasses:
+        for (width, height) in resolutions:
+            for settings in settingsList:
+                print('%s %dx%d %s' % (pipelineClass.__name__, width, \
+                    height, settings))
+                latencies = measure(pipelineClass, width, height, settings, \
+                    seconds, drawingArea.window.xid, outputDirectory)
+                printHistogram(latencies)
+                if latencies:
+                    summary.append((pipelineClass.__name__, width, height, \
+                        settings, Statistics.percentile(latencies, 0.5), \
+                        Statistics.percentile(latencies, 0.95)))
+    shutil.rmtree(outputDirectory, ignore_errors=True)
+    print('\npipeline                     resolution  median  95%  settings')
+    for (name, width, height, settings, median, high) in summary:
+        print('%-28s %4dx%-4d %7.1f %5.1f  %s' % (name, width, height, \
+            median, high, settings))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+
+'''This module contains a parallel motion jpeg decoder.  Every frame of an
+mjpeg stream is a keyframe so frames can be decoded independently of each
+other.  ParallelMjpegDecoder deals incoming frames out to several ffdec_mjpeg
+elements, each running in its own streaming thread, and puts the decoded
+frames back into their original order.  This lifts the single-core ceiling on
+frame rate at resolutions of 1600x1200 and above.'''
+
+__author__ = 'Paul Milliken'
+__licence__ = 'GPLv3'
+__version__ = 0.1
+__maintainer__ = 'Paul Milliken'
+__email__ = 'paul.milliken@gmail.com'
+__status__ = 'Prototype'
+
+import collections
+import threading
+import time
+import pygst
+pygst.require('0.10')
+import gobject
+import gst
+
+class FrameReorderer:
+    '''Keeps track of the frames that have been dealt out to the decoding
+    branches and releases decoded frames in the order they were dealt.  A
+    frame that has not come back within maxDelay seconds of a later frame
+    being ready is skipped, which bounds the latency added by reordering.'''
+
+    def __init__(self, numberOfBranches, maxDelay=0.1):
+        self.numberOfBranches = numberOfBranches
+        self.maxDelay = maxDelay
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # (sequence number, timestamp) of frames being decoded, per branch:
+        self.inFlight = [collections.deque() for i in \
+            range(self.numberOfBranches)]
+        # decoded frames waiting for their turn: seq -> (frame, arrival time)
+        self.ready = {}
+        self.lost = set()
+        self.nextDispatch = 0
+        self.nextOutput = 0
+        self.framesSkipped = 0
+
+    def dispatch(self, timestamp):
+        '''Records a frame as being sent for decoding and returns the index of
+        the branch it should be sent to'''
+        self.lock.acquire()
+        try:
+            seq = self.nextDispatch
+            branch = seq % self.numberOfBranches
+            self.inFlight[branch].append((seq, timestamp))
+            self.nextDispatch = seq + 1
+            return branch
+        finally:
+            self.lock.release()
+
+    def complete(self, branch, timestamp, frame, now=None):
+        '''Accepts a decoded frame from branch and returns a (possibly empty)
+        list of frames that are now ready to be output in order.  Branches
+        return frames in the order they were given them, so a mismatched
+        timestamp means the decoder dropped the frame at the head of the
+        branch.'''
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            queue = self.inFlight[branch]
+            seq = None
+            while queue:
+                (candidate, candidateTimestamp) = queue.popleft()
+                if timestamp is None or candidateTimestamp is None or \
+                    candidateTimestamp==timestamp:
+                    seq = candidate
+                    break
+                # frames before nextOutput have already been skipped:
+                if candidate >= self.nextOutput:
+                    self.lost.add(candidate)
+            if seq is not None and seq >= self.nextOutput:
+                self.ready[seq] = (frame, now)
+            return self.release(now)
+        finally:
+            self.lock.release()
+
+    def release(self, now):
+        '''Returns the frames that can be output, skipping frames that were
+        lost or are too late'''
+        frames = []
+        while True:
+            if self.nextOutput in self.ready:
+                frames.append(self.ready.pop(self.nextOutput)[0])
+            elif self.nextOutput in self.lost:
+                self.lost.remove(self.nextOutput)
+                self.framesSkipped = self.framesSkipped + 1
+            elif self.ready and now - min([arrival for (frame, arrival) \
+                in self.ready.values()]) > self.maxDelay:
+                self.framesSkipped = self.framesSkipped + 1
+            else:
+                break
+            self.nextOutput = self.nextOutput + 1
+        return frames
+
+class ParallelMjpegDecoder(gst.Bin):
+    '''A bin with a sink pad for image/jpeg and a src pad for decoded video
+    that can be used in place of a single ffdec_mjpeg element.  Internally:
+
+        appsink -> numberOfThreads x (appsrc ! ffdec_mjpeg ! appsink) -> appsrc
+
+    Each branch appsrc pushes from its own thread so the decoders run in
+    parallel.  Only one frame is queued per branch; when every branch is busy
+    the upstream thread waits, just as it would for a single decoder.
+
+    The output appsrc answers latency queries itself instead of passing them
+    upstream, so it is given the upstream latency (e.g. the rtspsrc
+    jitterbuffer) plus the reordering delay; see updateLatency.'''
+
+    def __init__(self, numberOfThreads=2, name=None, maxDelay=0.1):
+        gst.Bin.__init__(self, name)
+        self.numberOfThreads = numberOfThreads
+        self.reorderer = FrameReorderer(numberOfThreads, maxDelay)
+        self.outputLock = threading.Lock()
+        self.outputCaps = None
+        self.branchesAtEos = 0
+        self.latencyKnown = False
+        self.createInputElement()
+        self.createBranches()
+        self.createOutputElement()
+        self.add_pad(gst.GhostPad('sink', self.input.get_pad('sink')))
+        self.add_pad(gst.GhostPad('src', self.output.get_pad('src')))
+
+    def createInputElement(self):
+        self.input = gst.element_factory_make('appsink', 'decodeInput')
+        self.input.set_property('emit-signals', True)
+        self.input.set_property('sync', False)
+        self.input.connect('new-buffer', self.onInputBuffer)
+        self.input.connect('eos', self.onInputEos)
+        self.add(self.input)
+
+    def createBranches(self):
+        '''Each branch is appsrc ! ffdec_mjpeg ! appsink'''
+        self.branchSources = []
+        for i in range(self.numberOfThreads):
+            source = gst.element_factory_make('appsrc', 'decodeSource%d' % i)
+            source.set_property('format', gst.FORMAT_TIME)
+            source.set_property('block', True)
+            source.set_property('max-bytes', 1)
+            decode = gst.element_factory_make('ffdec_mjpeg', 'decode%d' % i)
+            sink = gst.element_factory_make('appsink', 'decodeSink%d' % i)
+            sink.set_property('emit-signals', True)
+            sink.set_property('sync', False)
+            sink.connect('new-buffer', self.onDecodedBuffer, i)
+            sink.connect('eos', self.onBranchEos)
+            self.add(source, decode, sink)
+            gst.element_link_many(source, decode, sink)
+            self.branchSources.append(source)
+
+    def createOutputElement(self):
+        self.output = gst.element_factory_make('appsrc', 'decodeOutput')
+        self.output.set_property('format', gst.FORMAT_TIME)
+        self.output.set_property('is-live', True)
+        self.add(self.output)
+
+    def do_change_state(self, transition):
+        '''Forgets about frames from any previous run of the pipeline'''
+        if transition==gst.STATE_CHANGE_READY_TO_PAUSED:
+            self.reorderer.reset()
+            self.outputCaps = None
+            self.branchesAtEos = 0
+            self.latencyKnown = False
+        return gst.Bin.do_change_state(self, transition)
+
+    def onInputBuffer(self, appsink):
+        '''Deals a jpeg frame out to the next decoding branch'''
+        buffer = appsink.emit('pull-buffer')
+        if not self.latencyKnown:
+            self.latencyKnown = True
+            self.updateLatency()
+        source = self.branchSources[self.reorderer.dispatch(\
+            self.getTimestamp(buffer))]
+        if source.get_property('caps') is None:
+            source.set_property('caps', buffer.get_caps())
+        source.emit('push-buffer', buffer)
+
+    def onDecodedBuffer(self, appsink, branch):
+        '''Called from the streaming thread of each branch.  Frames that are
+        ready are pushed out in order under outputLock.'''
+        buffer = appsink.emit('pull-buffer')
+        self.outputLock.acquire()
+        try:
+            for frame in self.reorderer.complete(branch, \
+                self.getTimestamp(buffer), buffer):
+                if frame.get_caps()!=self.outputCaps:
+                    self.outputCaps = frame.get_caps()
+                    self.output.set_property('caps', self.outputCaps)
+                self.output.emit('push-buffer', frame)
+        finally:
+            self.outputLock.release()
+
+    def onInputEos(self, appsink):
+        for source in self.branchSources:
+            source.emit('end-of-stream')
+
+    def onBranchEos(self, appsink):
+        '''The output stream ends once every branch has drained'''
+        self.outputLock.acquire()
+        self.branchesAtEos = self.branchesAtEos + 1
+        if self.branchesAtEos==self.numberOfThreads:
+            self.output.emit('end-of-stream')
+        self.outputLock.release()
+
+    def updateLatency(self):
+        '''Queries the latency upstream of the decoder and sets it, plus
+        maxDelay, as the latency of the output appsrc.  The pipeline is asked
+        to redistribute latency if it has changed.'''
+        peer = self.get_pad('sink').get_peer()
+        if peer is None:
+            return
+        query = gst.query_new_latency()
+        if not peer.query(query):
+            return
+        (live, minimum, maximum) = query.parse_latency()
+        delay = int(self.reorderer.maxDelay * gst.SECOND)
+        minimum = minimum + delay
+        if maximum==gst.CLOCK_TIME_NONE or maximum < 0:
+            maximum = -1
+        else:
+            maximum = maximum + delay
+        if minimum!=self.output.get_property('min-latency') or \
+            maximum!=self.output.get_property('max-latency'):
+            self.output.set_property('min-latency', minimum)
+            self.output.set_property('max-latency', maximum)
+            self.post_message(gst.message_new_latency(self))
+
+    def getTimestamp(self, buffer):
+        if buffer.timestamp==gst.CLOCK_TIME_NONE:
+            return None
+        return buffer.timestamp
+
+    def getFramesSkipped(self):
+        return self.reorderer.framesSkipped
+
+gobject.type_register(ParallelMjpegDecoder)
@@ -0,0 +1,442 @@
+#!/usr/bin/python
+
+'''This module allows recorded footage to be played back, seeked and scrubbed
+quickly.  The first time a recording is opened, its avi file is scanned and a
+sidecar index (recording.avi.idx) of frame offsets, sizes and timestamps is
+written next to it.  Timestamps come from the timestamp file
+(recording.avi.ts) written while recording; see
+RtspBaseClass.createTimestampWriter.  Both the index and the avi are
+memory-mapped so opening a multi-hour recording only touches the pages that
+are actually used.  Every mjpeg frame is a keyframe, so any frame in the
+index can be decoded and shown on its own.'''
+
+__author__ = 'Paul Milliken'
+__licence__ = 'GPLv3'
+__version__ = 0.1
+__maintainer__ = 'Paul Milliken'
+__email__ = 'paul.milliken@gmail.com'
+__status__ = 'Prototype'
+
+import bisect
+import datetime
+import glob
+import mmap
+import os
+import struct
+import pygst
+pygst.require('0.10')
+import gst
+import gtk
+import gobject
+import AxisRtsp
+import RecordingWriter
+
+# header: magic, number of frames, frame duration (ns), avi size, avi mtime,
+# width, height, timestamp file size.  Each entry: frame offset, frame size,
+# timestamp (ns).
+INDEX_MAGIC = b'HVINDEX2'
+INDEX_HEADER = struct.Struct('<8sQQQdIIQ')
+INDEX_ENTRY = struct.Struct('<QIQ')
+CHUNK_HEADER = struct.Struct('<4sI')
+# avimux writes 0 into the header until the recording is finalised, so use
+# the 10 frames per second of RtspBaseClass.createCapsfilterElement:
+DEFAULT_FRAME_DURATION = 100000000
+
+def getJpegSize(data):
+    '''Returns (width, height) from the start of frame marker of a jpeg image
+    or None if there is no start of frame marker'''
+    pos = 2
+    while pos + 9 <= len(data):
+        (ff, marker, length) = struct.unpack_from('>BBH', data, pos)
+        if ff!=0xFF:
+            return None
+        if marker in (0xC0, 0xC1, 0xC2):
+            (height, width) = struct.unpack_from('>HH', data, pos + 5)
+            return (width, height)
+        pos = pos + 2 + length
+    return None
+
+def scanAviFrames(data):
+    '''Returns (frame duration in ns, list of (offset, size)) for the video
+    frames of the avi file in data.  Only chunk headers are read.  Lists are
+    descended into rather than skipped so that OpenDML files (AVIX) and files
+    whose header was never finalised are handled.  Chunks that do not start
+    with a jpeg start of image marker (e.g. where the RecordingWriter left a
+    hole) are left out, and after a damaged chunk header the scan resyncs on
+    the next video chunk.'''
+    frameDuration = 0
+    frames = []
+    pos = 12 # skip RIFF, size, 'AVI '
+    end = len(data)
+    while pos + CHUNK_HEADER.size <= end:
+        (fourcc, length) = CHUNK_HEADER.unpack_from(data, pos)
+        if fourcc in (b'RIFF', b'LIST'):
+            pos = pos + 12
+            continue
+        if not all([32 <= c <= 126 for c in bytearray(fourcc)]):
+            pos = data.find(b'00dc', pos + 1)
+            if pos < 0:
+                break
+            continue
+        if pos + 8 + length > end:
+            break # recording was cut short
+        if fourcc==b'avih':
+            frameDuration = 1000 * struct.unpack_from('<I', data, pos + 8)[0]
+        elif fourcc[2:] in (b'dc', b'db') and length > 2 and \
+            data[pos + 8:pos + 10]==b'\xff\xd8':
+            frames.append((pos + 8, length))
+        pos = pos + 8 + length + (length & 1)
+    return (frameDuration or DEFAULT_FRAME_DURATION, frames)
+
+def matchTimestamps(frames, entries, frameDuration):
+    '''Returns a timestamp (ns) for each of frames, a list of (offset, size)
+    from scanAviFrames, given the (timestamp, size) entries of the timestamp
+    file.  Both are in recording order but frames that the scan left out,
+    e.g. in a hole, have entries, so each frame takes the next entry of the
+    same size.  A frame without a matching entry (or every frame of a
+    recording without a timestamp file) is placed frameDuration after the
+    previous one.'''
+    positions = {}
+    for (position, (timestamp, size)) in enumerate(entries):
+        positions.setdefault(size, []).append(position)
+    timestamps = []
+    nextEntry = 0
+    for (offset, size) in frames:
+        candidates = positions.get(size, [])
+        i = bisect.bisect_left(candidates, nextEntry)
+        if i < len(candidates):
+            nextEntry = candidates[i] + 1
+            timestamp = entries[candidates[i]][0]
+        elif timestamps:
+            timestamp = timestamps[-1] + frameDuration
+        else:
+            timestamp = 0
+        if timestamps:
+            timestamp = max(timestamp, timestamps[-1])
+        timestamps.append(timestamp)
+    return timestamps
+
+class RecordingIndex:
+    '''The frame index of one recording.  The index is built lazily when it
+    is first opened and rebuilt if the avi has changed since.'''
+
+    def __init__(self, aviFilename):
+        self.aviFilename = aviFilename
+        self.indexFilename = aviFilename + '.idx'
+        self.timestampFilename = aviFilename + '.ts'
+        self.aviMap = None
+        self.openIndex()
+
+    def openIndex(self):
+        stat = os.stat(self.aviFilename)
+        if not self.indexIsCurrent(stat):
+            self.buildIndex(stat)
+        indexFile = open(self.indexFilename, 'rb')
+        self.indexMap = mmap.mmap(indexFile.fileno(), 0, \
+            access=mmap.ACCESS_READ)
+        indexFile.close()
+        (magic, self.numberOfFrames, self.frameDuration, size, mtime, \
+            self.width, self.height, timestampSize) = \
+            INDEX_HEADER.unpack_from(self.indexMap)
+
+    def indexIsCurrent(self, stat):
+        try:
+            indexFile = open(self.indexFilename, 'rb')
+        except IOError:
+            return False
+        header = indexFile.read(INDEX_HEADER.size)
+        indexFile.close()
+        if len(header)!=INDEX_HEADER.size:
+            return False
+        (magic, numberOfFrames, frameDuration, size, mtime, width, height, \
+            timestampSize) = INDEX_HEADER.unpack(header)
+        return magic==INDEX_MAGIC and size==stat.st_size and \
+            mtime==stat.st_mtime and timestampSize==self.getTimestampSize()
+
+    def getTimestampSize(self):
+        try:
+            return os.path.getsize(self.timestampFilename)
+        except OSError:
+            return 0
+
+    def readTimestampEntries(self):
+        '''Returns the (timestamp, size) entries of the timestamp file, or an
+        empty list if there is none'''
+        try:
+            timestampFile = open(self.timestampFilename, 'rb')
+        except IOError:
+            return []
+        data = timestampFile.read()
+        timestampFile.close()
+        entrySize = AxisRtsp.TIMESTAMP_ENTRY.size
+        return [AxisRtsp.TIMESTAMP_ENTRY.unpack_from(data, pos) for pos in \
+            range(0, len(data) - entrySize + 1, entrySize)]
+
+    def buildIndex(self, stat):
+        '''Scans the avi and writes the sidecar index'''
+        print('Indexing %s' % self.aviFilename)
+        timestampSize = self.getTimestampSize()
+        (frameDuration, frames) = (DEFAULT_FRAME_DURATION, [])
+        if stat.st_size > 12:
+            (frameDuration, frames) = scanAviFrames(self.getAviMap())
+        (width, height) = (0, 0)
+        if frames:
+            (offset, length) = frames[0]
+            (width, height) = getJpegSize(self.aviMap[offset:offset + \
+                length]) or (0, 0)
+        temporaryFilename = self.indexFilename + '.tmp'
+        indexFile = open(temporaryFilename, 'wb')
+        indexFile.write(INDEX_HEADER.pack(INDEX_MAGIC, len(frames), \
+            frameDuration, stat.st_size, stat.st_mtime, width, height, \
+            timestampSize))
+        timestamps = matchTimestamps(frames, self.readTimestampEntries(), \
+            frameDuration)
+        for ((offset, length), timestamp) in zip(frames, timestamps):
+            indexFile.write(INDEX_ENTRY.pack(offset, length, timestamp))
+        indexFile.close()
+        os.rename(temporaryFilename, self.indexFilename)
+
+    def getAviMap(self):
+        if self.aviMap is None:
+            aviFile = open(self.aviFilename, 'rb')
+            self.aviMap = mmap.mmap(aviFile.fileno(), 0, \
+                access=mmap.ACCESS_READ)
+            aviFile.close()
+        return self.aviMap
+
+    def __len__(self):
+        return self.numberOfFrames
+
+    def getEntry(self, frameNumber):
+        '''Returns (offset, size, timestamp) of a frame'''
+        return INDEX_ENTRY.unpack_from(self.indexMap, INDEX_HEADER.size + \
+            frameNumber * INDEX_ENTRY.size)
+
+    def getTimestamp(self, frameNumber):
+        return self.getEntry(frameNumber)[2]
+
+    def getDuration(self):
+        if self.numberOfFrames==0:
+            return 0
+        return self.getTimestamp(self.numberOfFrames - 1) + self.frameDuration
+
+    def getFrameNumber(self, timestamp):
+        '''Returns the last frame at or before timestamp (ns) by a binary
+        search of the index'''
+        (low, high) = (0, self.numberOfFrames)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self.getTimestamp(middle) <= timestamp:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def getFrameData(self, frameNumber):
+        '''Returns the jpeg image of a frame'''
+        (offset, size, timestamp) = self.getEntry(frameNumber)
+        return self.getAviMap()[offset:offset + size]
+
+class RecordingSet:
+    '''A set of recordings (segments) played back as one timeline.  Segments
+    are ordered by the time in their filename, as given by
+    RtspBaseClass.assignOutputFilename.  Indexes are opened when a segment
+    is first used.'''
+
+    def __init__(self, aviFilenames):
+        # recordings started within the same second are numbered, and the
+        # shorter name comes first:
+        segments = [(self.getStartTime(filename), len(filename), filename) \
+            for filename in aviFilenames]
+        segments.sort()
+        self.filenames = [filename for (startTime, length, filename) in \
+            segments]
+        self.startTimes = [startTime for (startTime, length, filename) in \
+            segments]
+        self.indexes = [None] * len(self.filenames)
+
+    def fromDirectory(cls, directory='.'):
+        '''Recordings that are still being written are left out, since their
+        index would miss the end of the recording'''
+        return cls([filename for filename in glob.glob(os.path.join(\
+            directory, '[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*.avi')) if \
+            not RecordingWriter.isLocationOpen(filename) and \
+            not RecordingWriter.isLocationOpen(filename + '.ts')])
+    fromDirectory = classmethod(fromDirectory)
+
+    def getStartTime(self, filename):
+        try:
+            return datetime.datetime.strptime(\
+                os.path.basename(filename)[:19], '%Y_%m_%d_%H_%M_%S')
+        except ValueError:
+            return datetime.datetime.fromtimestamp(os.path.getmtime(filename))
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def getIndex(self, segment):
+        if self.indexes[segment] is None:
+            self.indexes[segment] = RecordingIndex(self.filenames[segment])
+        return self.indexes[segment]
+
+    def getTime(self, segment, frameNumber):
+        '''Returns the wall clock time of a frame'''
+        return self.startTimes[segment] + datetime.timedelta(microseconds=\
+            self.getIndex(segment).getTimestamp(frameNumber) // 1000)
+
+    def locate(self, time):
+        '''Returns (segment, frame number) of the frame shown at wall clock
+        time.  Times between segments give the last frame of the earlier
+        segment.'''
+        segment = max(0, bisect.bisect_right(self.startTimes, time) - 1)
+        index = self.getIndex(segment)
+        offset = time - self.startTimes[segment]
+        timestamp = (offset.days * 86400 + offset.seconds) * 1000000000 + \
+            offset.microseconds * 1000
+        return (segment, index.getFrameNumber(max(0, timestamp)))
+
+    def getThumbnailFrames(self, segment, numberOfThumbnails):
+        '''Returns frame numbers evenly spaced across a segment'''
+        numberOfFrames = len(self.getIndex(segment))
+        return [i * numberOfFrames // numberOfThumbnails for i in \
+            range(numberOfThumbnails) if numberOfFrames > 0]
+
+def createThumbnail(jpegData, height):
+    '''Decodes a jpeg image into a gtk.gdk.Pixbuf scaled to height.  The
+    loader scales while decoding so full size images are never held.'''
+    loader = gtk.gdk.PixbufLoader('jpeg')
+    def onSizePrepared(loader, width, fullHeight):
+        loader.set_size(max(1, width * height // fullHeight), height)
+    loader.connect('size-prepared', onSizePrepared)
+    loader.write(jpegData)
+    loader.close()
+    return loader.get_pixbuf()
+
+class RecordingPlayer(AxisRtsp.RtspBaseClass):
+    '''Plays a RecordingSet to an xvimagesink.  Frames are read straight from
+    the memory-mapped avi using the index and pushed into an appsrc, so
+    seeking to any frame is immediate.  The pipeline stays playing; pausing
+    only stops frames from being pushed.'''
+
+    def __init__(self, recordingSet, xid, decodeThreads=1):
+        self.recordingSet = recordingSet
+        # xid is the xwindow I.D. where the video will be displayed:
+        self.xid = xid
+        self.decodeThreads = decodeThreads
+        self.segment = 0
+        self.frameNumber = 0
+        self.timer = None
+        self.createGstreamerPipeline()
+
+    def createGstreamerPipeline(self):
+        '''appsrc ! ffdec_mjpeg ! ffmpegcolorspace ! xvimagesink'''
+        self.createEmptyPipeline()
+        self.createPipelineElements()
+        self.addElementsToPipeline()
+        self.linkPipelineElements()
+
+    def createPipelineElements(self):
+        self.createAppsrcElement()
+        self.createDecodeElement()
+        self.createFfmpegcolorspaceElement()
+        self.createXvimagesinkElement()
+        # frames are shown as soon as they are pushed:
+        self.xvimagesink.set_property('sync', False)
+
+    def createAppsrcElement(self):
+        self.source = gst.element_factory_make('appsrc', 'source')
+        self.source.set_property('is-live', True)
+        self.source.set_property('do-timestamp', True)
+        self.source.set_property('format', gst.FORMAT_TIME)
+
+    def addElementsToPipeline(self):
+        self.pipeline.add(self.source)
+        self.pipeline.add(self.decode)
+        self.pipeline.add(self.ffmpegcolorspace)
+        self.pipeline.add(self.xvimagesink)
+
+    def linkPipelineElements(self):
+        self.source.link(self.decode)
+        self.decode.link(self.ffmpegcolorspace)
+        self.ffmpegcolorspace.link(self.xvimagesink)
+
+    def setPipelineStateToPlaying(self):
+        self.pipeline.set_state(gst.STATE_PLAYING)
+        self.showFrame(self.segment, self.frameNumber)
+        self.startTimer()
+
+    def setPipelineStateToPaused(self):
+        self.stopTimer()
+
+    def setPipelineStateToNull(self):
+        self.stopTimer()
+        self.pipeline.set_state(gst.STATE_NULL)
+
+    def pauseOrUnpauseVideo(self):
+        if self.timer is None:
+            self.startTimer()
+        else:
+            self.stopTimer()
+
+    def startTimer(self):
+        '''The next frame is shown after the time recorded between it and the
+        current frame'''
+        if self.timer is None:
+            index = self.recordingSet.getIndex(self.segment)
+            interval = index.frameDuration
+            if self.frameNumber + 1 < len(index):
+                interval = index.getTimestamp(self.frameNumber + 1) - \
+                    index.getTimestamp(self.frameNumber)
+            self.timer = gobject.timeout_add(max(1, interval // 1000000), \
+                self.onTimer)
+
+    def stopTimer(self):
+        if self.timer is not None:
+            gobject.source_remove(self.timer)
+            self.timer = None
+
+    def onTimer(self):
+        '''Shows the next frame, moving on to the next segment at the end of
+        each one and stopping at the end of the set'''
+        if self.frameNumber + 1 < len(self.recordingSet.getIndex(\
+            self.segment)):
+            self.showFrame(self.segment, self.frameNumber + 1)
+        elif self.segment + 1 < len(self.recordingSet):
+            self.showFrame(self.segment + 1, 0)
+        else:
+            self.timer = None
+            return False
+        self.timer = None
+        self.startTimer()
+        return False
+
+    def showFrame(self, segment, frameNumber):
+        '''Pushes one frame into the pipeline'''
+        index = self.recordingSet.getIndex(segment)
+        if len(index)==0:
+            return
+        self.segment = segment
+        self.frameNumber = min(frameNumber, len(index) - 1)
+        caps = gst.caps_from_string('image/jpeg,width=%d,height=%d,' \
+            'framerate=%d/1000' % (index.width, index.height, \
+            1000000000000 // index.frameDuration))
+        if self.source.get_property('caps')!=caps:
+            self.source.set_property('caps', caps)
+        self.source.emit('push-buffer', \
+            gst.Buffer(index.getFrameData(self.frameNumber)))
+
+    def getCurrentTime(self):
+        return self.recordingSet.getTime(self.segment, self.frameNumber)
+
+    def seekBy(self, seconds):
+        '''Scrubs forwards (or backwards if seconds is negative) through the
+        whole set'''
+        (segment, frameNumber) = self.recordingSet.locate(\
+            self.getCurrentTime() + datetime.timedelta(seconds=seconds))
+        self.showFrame(segment, frameNumber)
+
+    def stepBy(self, frames):
+        self.showFrame(self.segment, max(0, self.frameNumber + frames))
+
+    def seekToSegment(self, segment):
+        self.showFrame(segment % len(self.recordingSet), 0)
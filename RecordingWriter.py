@@ -0,0 +1,253 @@
+#!/usr/bin/python
+
+'''This module contains the RecordingWriter class which writes recorded video
+to disk on a dedicated thread.  The GStreamer streaming thread only copies
+data into a bounded in-memory buffer so that a slow or stalled disk (e.g. SD
+or USB media in the cab) cannot hold up the pipeline.'''
+
+__author__ = 'Paul Milliken'
+__licence__ = 'GPLv3'
+__version__ = 0.1
+__maintainer__ = 'Paul Milliken'
+__email__ = 'paul.milliken@gmail.com'
+__status__ = 'Prototype'
+
+import collections
+import os
+import threading
+import time
+
+# files that RecordingWriters have open; see isLocationOpen:
+openLocations = set()
+openLocationsLock = threading.Lock()
+
+def isLocationOpen(location):
+    '''Returns True if a RecordingWriter is still writing to location, e.g.
+    while a recording that has been stopped is being finalised'''
+    openLocationsLock.acquire()
+    try:
+        return os.path.abspath(location) in openLocations
+    finally:
+        openLocationsLock.release()
+
+def getOpenLocations():
+    openLocationsLock.acquire()
+    try:
+        return list(openLocations)
+    finally:
+        openLocationsLock.release()
+
+class RecordingWriter:
+    '''A RecordingWriter accepts data with write(...) and writes it to the file
+    given to open(...) in large batches that end on block boundaries.  At most
+    maxBufferedBytes are held in memory.  If the disk cannot keep up for
+    longer than stallTimeout seconds, incoming data is dropped.  Dropped data
+    is replaced by a hole of the same length so that the byte offsets that the
+    muxer has written into its index remain valid.'''
+
+    def __init__(self, maxBufferedBytes=32*1024*1024, batchSize=1024*1024, \
+        blockSize=4096, stallTimeout=2.0, flushInterval=1.0):
+        self.maxBufferedBytes = maxBufferedBytes
+        self.batchSize = batchSize
+        self.blockSize = blockSize
+        self.stallTimeout = stallTimeout
+        self.flushInterval = flushInterval
+        self.condition = threading.Condition()
+        self.thread = None
+        self.fd = None
+        self.location = None
+        self.initialiseVariables()
+
+    def initialiseVariables(self):
+        '''Resets the buffer and the statistics'''
+        self.pending = collections.deque()
+        self.batch = bytearray()
+        self.bufferedBytes = 0
+        self.position = 0
+        self.closing = False
+        self.degraded = False
+        # statistics:
+        self.bytesWritten = 0
+        self.bytesDropped = 0
+        self.writeSeconds = 0.0
+        self.bufferHighWater = 0
+        self.openTime = None
+        self.closeTime = None
+
+    def open(self, location):
+        '''Opens (and truncates) location and starts the writer thread.  Any
+        file that is already open is closed first.'''
+        self.close()
+        self.initialiseVariables()
+        self.location = location
+        self.openTime = time.time()
+        self.fd = os.open(location, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, \
+            0o644)
+        openLocationsLock.acquire()
+        openLocations.add(os.path.abspath(location))
+        openLocationsLock.release()
+        self.thread = threading.Thread(target=self.run, \
+            name='RecordingWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def isOpen(self):
+        return self.fd is not None
+
+    def close(self):
+        '''Writes out everything that is buffered, then stops the writer thread
+        and closes the file'''
+        if self.thread is None:
+            return
+        self.condition.acquire()
+        self.closing = True
+        self.condition.notify_all()
+        self.condition.release()
+        self.thread.join()
+        self.thread = None
+        os.close(self.fd)
+        self.fd = None
+        self.closeTime = time.time()
+        openLocationsLock.acquire()
+        openLocations.discard(os.path.abspath(self.location))
+        openLocationsLock.release()
+
+    def write(self, data):
+        '''Called from the streaming thread.  Returns True if data was queued
+        or False if it was dropped.'''
+        self.condition.acquire()
+        try:
+            if self.thread is None or self.closing:
+                return False
+            deadline = time.time() + self.stallTimeout
+            while self.bufferedBytes + len(data) > self.maxBufferedBytes:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.pending.append(('skip', len(data)))
+                    self.bytesDropped = self.bytesDropped + len(data)
+                    if not self.degraded:
+                        print('Disk too slow: dropping recorded data')
+                    self.degraded = True
+                    self.condition.notify_all()
+                    return False
+                self.condition.wait(remaining)
+            self.pending.append(('data', data))
+            self.bufferedBytes = self.bufferedBytes + len(data)
+            self.bufferHighWater = max(self.bufferHighWater, \
+                self.bufferedBytes)
+            self.condition.notify_all()
+            return True
+        finally:
+            self.condition.release()
+
+    def seek(self, offset):
+        '''Subsequent data is written at the absolute offset given.  Muxers use
+        this to rewrite their headers at the end of a recording.'''
+        self.queueCommand(('seek', offset))
+
+    def flush(self):
+        '''Blocks until all data queued so far has been written to disk'''
+        done = threading.Event()
+        if self.queueCommand(('flush', done)):
+            done.wait()
+
+    def queueCommand(self, command):
+        self.condition.acquire()
+        try:
+            if self.thread is None or self.closing:
+                return False
+            self.pending.append(command)
+            self.condition.notify_all()
+            return True
+        finally:
+            self.condition.release()
+
+    def getStatistics(self):
+        '''Returns a dictionary of write throughput, buffer high water mark and
+        dropped byte count.  writeThroughput is bytes per second spent in
+        os.write, which mostly measures the page cache, so averageThroughput
+        (bytes per second of wall clock time while the file was open) is
+        given as well.'''
+        self.condition.acquire()
+        try:
+            if self.writeSeconds > 0:
+                throughput = self.bytesWritten / self.writeSeconds
+            else:
+                throughput = 0.0
+            averageThroughput = 0.0
+            if self.openTime is not None:
+                elapsed = (self.closeTime or time.time()) - self.openTime
+                if elapsed > 0:
+                    averageThroughput = self.bytesWritten / elapsed
+            return {'location': self.location, \
+                'bytesWritten': self.bytesWritten, \
+                'bytesDropped': self.bytesDropped, \
+                'writeThroughput': throughput, \
+                'averageThroughput': averageThroughput, \
+                'bufferedBytes': self.bufferedBytes, \
+                'bufferHighWater': self.bufferHighWater, \
+                'maxBufferedBytes': self.maxBufferedBytes, \
+                'degraded': self.degraded}
+        finally:
+            self.condition.release()
+
+    def run(self):
+        '''Main loop of the writer thread'''
+        while True:
+            self.condition.acquire()
+            if not self.pending and not self.closing:
+                self.condition.wait(self.flushInterval)
+            items = self.pending
+            self.pending = collections.deque()
+            closing = self.closing
+            self.condition.release()
+            for (kind, payload) in items:
+                if kind=='data':
+                    self.batch.extend(payload)
+                    if len(self.batch) >= self.batchSize:
+                        self.writeBatch(aligned=True)
+                elif kind=='skip':
+                    self.writeBatch()
+                    self.position = self.position + payload
+                    os.lseek(self.fd, self.position, os.SEEK_SET)
+                elif kind=='seek':
+                    self.writeBatch()
+                    self.position = payload
+                    os.lseek(self.fd, self.position, os.SEEK_SET)
+                elif kind=='flush':
+                    self.writeBatch()
+                    payload.set()
+            if closing and not self.pending:
+                self.writeBatch()
+                # a trailing hole must still extend the file:
+                if os.fstat(self.fd).st_size < self.position:
+                    os.ftruncate(self.fd, self.position)
+                break
+            if not items:
+                # nothing arrived within flushInterval so write what we can:
+                self.writeBatch(aligned=True)
+
+    def writeBatch(self, aligned=False):
+        '''Writes the batch to disk.  If aligned is True, only the part that
+        ends on a block boundary is written and the rest is kept.'''
+        length = len(self.batch)
+        if aligned:
+            end = ((self.position + length) // self.blockSize) * \
+                self.blockSize
+            length = max(0, end - self.position)
+        if length==0:
+            return
+        data = self.batch[:length]
+        startTime = time.time()
+        written = 0
+        while written < length:
+            written = written + os.write(self.fd, bytes(data[written:]))
+        elapsed = time.time() - startTime
+        del self.batch[:length]
+        self.position = self.position + length
+        self.condition.acquire()
+        self.bytesWritten = self.bytesWritten + length
+        self.writeSeconds = self.writeSeconds + elapsed
+        self.bufferedBytes = self.bufferedBytes - length
+        self.condition.notify_all()
+        self.condition.release()
@@ -0,0 +1,15 @@
+#!/usr/bin/python
+
+'''Small statistics helpers shared by the benchmarks.'''
+
+__author__ = 'Paul Milliken'
+__licence__ = 'GPLv3'
+__version__ = 0.1
+__maintainer__ = 'Paul Milliken'
+__email__ = 'paul.milliken@gmail.com'
+__status__ = 'Prototype'
+
+def percentile(values, fraction):
+    '''Returns the value below which fraction of values lie'''
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
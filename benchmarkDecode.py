@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+'''Benchmarks mjpeg decoding against the number of decode threads.  Frames are
+encoded once with jpegenc and held in memory, then pushed as fast as possible
+through either a single ffdec_mjpeg element (1 thread) or a
+ParallelDecode.ParallelMjpegDecoder.  For each thread count the frame rate
+and the per-frame decode latency (time from entering to leaving the decoder)
+are printed.
+
+Usage: python benchmarkDecode.py [width height [numberOfFrames [maxThreads]]]
+'''
+
+__author__ = 'Paul Milliken'
+__licence__ = 'GPLv3'
+__version__ = 0.1
+__maintainer__ = 'Paul Milliken'
+__email__ = 'paul.milliken@gmail.com'
+__status__ = 'Prototype'
+
+import sys
+import time
+import pygst
+pygst.require('0.10')
+import gobject
+gobject.threads_init()
+import gst
+import ParallelDecode
+import Statistics
+
+def encodeFrames(width, height, numberOfFrames):
+    '''Returns a list of jpeg encoded gst.Buffers from videotestsrc'''
+    pipeline = gst.parse_launch('videotestsrc num-buffers=%d ! ' \
+        'video/x-raw-yuv,width=%d,height=%d,framerate=25/1 ! jpegenc ! ' \
+        'appsink name=sink sync=false' % (numberOfFrames, width, height))
+    sink = pipeline.get_by_name('sink')
+    pipeline.set_state(gst.STATE_PLAYING)
+    frames = []
+    while True:
+        buffer = sink.emit('pull-buffer')
+        if buffer is None:
+            break
+        frames.append(buffer)
+    pipeline.set_state(gst.STATE_NULL)
+    return frames
+
+def runDecode(frames, decodeThreads):
+    '''Decodes frames and returns (frames per second, list of latencies)'''
+    pipeline = gst.Pipeline('benchmark')
+    source = gst.element_factory_make('appsrc', 'source')
+    source.set_property('caps', frames[0].get_caps())
+    source.set_property('format', gst.FORMAT_TIME)
+    if decodeThreads > 1:
+        decode = ParallelDecode.ParallelMjpegDecoder(decodeThreads, 'decode')
+    else:
+        decode = gst.element_factory_make('ffdec_mjpeg', 'decode')
+    sink = gst.element_factory_make('fakesink', 'sink')
+    sink.set_property('sync', False)
+    pipeline.add(source, decode, sink)
+    gst.element_link_many(source, decode, sink)
+    entryTimes = {}
+    latencies = []
+    def onDecodeInput(pad, buffer):
+        entryTimes[buffer.timestamp] = time.time()
+        return True
+    def onDecodeOutput(pad, buffer):
+        if buffer.timestamp in entryTimes:
+            latencies.append(time.time() - entryTimes.pop(buffer.timestamp))
+        return True
+    decode.get_pad('sink').add_buffer_probe(onDecodeInput)
+    decode.get_pad('src').add_buffer_probe(onDecodeOutput)
+    pipeline.set_state(gst.STATE_PLAYING)
+    startTime = time.time()
+    for frame in frames:
+        source.emit('push-buffer', frame)
+    source.emit('end-of-stream')
+    bus = pipeline.get_bus()
+    bus.timed_pop_filtered(gst.CLOCK_TIME_NONE, \
+        gst.MESSAGE_EOS | gst.MESSAGE_ERROR)
+    elapsed = time.time() - startTime
+    pipeline.set_state(gst.STATE_NULL)
+    return (len(latencies) / elapsed, latencies)
+
+def main():
+    width = 1600
+    height = 1200
+    numberOfFrames = 200
+    maxThreads = 4
+    if len(sys.argv) > 2:
+        width = int(sys.argv[1])
+        height = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        numberOfFrames = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        maxThreads = int(sys.argv[4])
+    print('Encoding %d frames at %dx%d' % (numberOfFrames, width, height))
+    frames = encodeFrames(width, height, numberOfFrames)
+    print('threads      fps   median latency (ms)   95%% latency (ms)')
+    for decodeThreads in range(1, maxThreads + 1):
+        (fps, latencies) = runDecode(frames, decodeThreads)
+        print('%7d %8.1f %22.1f %18.1f' % (decodeThreads, fps, \
+            1000 * Statistics.percentile(latencies, 0.5), \
+            1000 * Statistics.percentile(latencies, 0.95)))
+
+if __name__=='__main__':
+    main()
@@ -3,7 +3,8 @@
 '''This program displays an RTSP video stream from an Axis camera.  More than
 one camera is allowed and user can switch between camera views.  Currently,
 the user can also digitally zoom, pan and tilt and digitally lighten and darken
-the image.
+the image, and start and stop recording to file without interrupting the view.
+Recordings can be played back, scrubbed and seeked in a playback mode.
 
 To do:
   * Use optical lightening and darkening via cgi interface instead of digitally
@@ -55,6 +56,7 @@ __status__ = 'Prototype'
 
 import subprocess
 import AxisRtsp
+import Playback
 import pygtk
 import gtk
 import time
@@ -67,10 +69,14 @@ class OperatorInterface:
     can swap cameras and digitally pan, tilt and zoom.  Currently, only Axis 
     P1347 cameras have been tested.'''
 
-    def __init__(self, ipAddressList, pipelineType='lightenOnly'):
-        '''Sets up the GTK interface and the RTSP pipelines using GStreamer'''
+    def __init__(self, ipAddressList, pipelineType='lightenOnly', \
+        decodeThreads=1):
+        '''Sets up the GTK interface and the RTSP pipelines using GStreamer.
+        decodeThreads > 1 decodes mjpeg on several cores, which helps at
+        resolutions of 1600x1200 and above.'''
         self.ipAddressList = ipAddressList
         self.pipelineType = pipelineType
+        self.decodeThreads = decodeThreads
         self.numberOfCameras = len(ipAddressList)
         self.initialiseVariables()
         self.setUpGTKWindow()
@@ -92,6 +98,12 @@ class OperatorInterface:
         self.right = [0] * self.numberOfCameras #left border (pixels)
         self.top = [0] * self.numberOfCameras #left border (pixels)
         self.bottom = [0] * self.numberOfCameras #left border (pixels)
+        # variables relating to playback of recordings:
+        self.playbackMode = False
+        self.numberOfThumbnails = 8
+        self.thumbnailHeight = 90 # pixels
+        self.thumbnailSegment = None
+        self.resumeRecording = False
 
     def setUpGTKWindow(self):
         '''There is only one fullscreen window with no buttons'''
@@ -99,9 +111,21 @@ class OperatorInterface:
         self.vbox = gtk.VBox()
         self.drawingArea = gtk.DrawingArea()
         self.vbox.pack_start(self.drawingArea)
+        self.createThumbnailStrip()
         self.window.add(self.vbox)
         self.window.show_all()
+        self.thumbnailStrip.hide()
         self.goFullscreen()
+
+    def createThumbnailStrip(self):
+        '''The thumbnail strip is only shown in playback mode'''
+        self.thumbnailStrip = gtk.HBox()
+        self.thumbnailImages = []
+        for i in range(self.numberOfThumbnails):
+            image = gtk.Image()
+            self.thumbnailImages.append(image)
+            self.thumbnailStrip.pack_start(image)
+        self.vbox.pack_start(self.thumbnailStrip, expand=False)
     
     def setUpGTKCallbacks(self):
         self.window.connect('destroy', self.quitApplication)
@@ -120,10 +144,22 @@ class OperatorInterface:
         if (event.keyval==gtk.keysyms.BackSpace or \
             event.keyval==gtk.keysyms.q):
             self.quitApplication(widget)
+        if (event.keyval==gtk.keysyms.KP_9 or \
+            event.keyval==gtk.keysyms.KP_Page_Up or \
+            event.keyval==gtk.keysyms.v):
+            self.togglePlaybackMode()
+            return
+        if self.playbackMode:
+            self.onPlaybackKeypress(event)
+            return
         if (event.keyval==gtk.keysyms.KP_5 or \
             event.keyval==gtk.keysyms.KP_Begin or \
             event.keyval==gtk.keysyms.p):
             self.rtspPipeline.pauseOrUnpauseVideo()
+        if (event.keyval==gtk.keysyms.KP_0 or \
+            event.keyval==gtk.keysyms.KP_Insert or \
+            event.keyval==gtk.keysyms.r):
+            self.rtspPipeline.toggleRecording()
         if (event.keyval==gtk.keysyms.KP_Enter or \
             event.keyval==gtk.keysyms.space):
             self.incrementCamera()
@@ -155,6 +191,104 @@ class OperatorInterface:
         if (event.keyval==gtk.keysyms.KP_Multiply or \
             event.keyval==gtk.keysyms.d):
             self.darken()
+
+    def onPlaybackKeypress(self, event):
+        '''In playback mode, left and right scrub by 10 seconds, up and down
+        by 10 minutes, + and - step one frame and enter moves on to the next
+        recording'''
+        if (event.keyval==gtk.keysyms.KP_5 or \
+            event.keyval==gtk.keysyms.KP_Begin or \
+            event.keyval==gtk.keysyms.p):
+            self.player.pauseOrUnpauseVideo()
+        if (event.keyval==gtk.keysyms.KP_Enter or \
+            event.keyval==gtk.keysyms.space):
+            self.player.seekToSegment(self.player.segment + 1)
+        if (event.keyval==gtk.keysyms.KP_Decimal or \
+            event.keyval==gtk.keysyms.KP_Delete or \
+            event.keyval==gtk.keysyms.f):
+            self.toggleFullscreen()
+        if (event.keyval==gtk.keysyms.KP_Add or \
+            event.keyval==gtk.keysyms.equal):
+            self.player.stepBy(1)
+        if (event.keyval==gtk.keysyms.KP_Subtract or \
+            event.keyval==gtk.keysyms.minus):
+            self.player.stepBy(-1)
+        if (event.keyval==gtk.keysyms.KP_Up or event.keyval==gtk.keysyms.KP_8 \
+            or event.keyval==gtk.keysyms.Up):
+            self.player.seekBy(600)
+        if (event.keyval==gtk.keysyms.KP_Down or \
+            event.keyval==gtk.keysyms.Down or event.keyval==gtk.keysyms.KP_2):
+            self.player.seekBy(-600)
+        if (event.keyval==gtk.keysyms.KP_Left or \
+            event.keyval==gtk.keysyms.KP_4 or event.keyval==gtk.keysyms.Left):
+            self.player.seekBy(-10)
+        if (event.keyval==gtk.keysyms.KP_Right or \
+            event.keyval==gtk.keysyms.KP_6 or event.keyval==gtk.keysyms.Right):
+            self.player.seekBy(10)
+        self.updateThumbnailStrip()
+
+    def togglePlaybackMode(self):
+        if self.playbackMode:
+            self.exitPlaybackMode()
+        else:
+            self.enterPlaybackMode()
+
+    def enterPlaybackMode(self):
+        '''Stops the live view and plays back recordings in the output
+        directory of the live pipeline, starting at the most recent one.  A recording in progress
+        is stopped, so that its file is finalised, and started again in a new
+        file when the live view returns.'''
+        self.resumeRecording = self.rtspPipeline.isRecording()
+        self.rtspPipeline.stopRecording()
+        self.rtspPipeline.setPipelineStateToNull()
+        if not self.rtspPipeline.waitForRecordingsToFinish():
+            print('A recording is still being written and cannot be played')
+        recordingSet = Playback.RecordingSet.fromDirectory(\
+            self.rtspPipeline.outputDirectory)
+        if len(recordingSet)==0:
+            print('No recordings to play back')
+            self.resumeLiveView()
+            return
+        self.player = Playback.RecordingPlayer(recordingSet, \
+            self.drawingArea.window.xid, self.decodeThreads)
+        self.player.segment = len(recordingSet) - 1
+        self.player.setPipelineStateToPlaying()
+        self.playbackMode = True
+        self.thumbnailStrip.show()
+        self.updateThumbnailStrip()
+
+    def exitPlaybackMode(self):
+        '''Returns to the live view'''
+        self.player.setPipelineStateToNull()
+        self.player = None
+        self.playbackMode = False
+        self.thumbnailStrip.hide()
+        self.thumbnailSegment = None
+        self.resumeLiveView()
+
+    def resumeLiveView(self):
+        '''Plays the live pipeline again, recording if it was before
+        playback'''
+        if self.resumeRecording:
+            self.resumeRecording = False
+            self.rtspPipeline.startRecording()
+        self.rtspPipeline.setPipelineStateToPlaying()
+
+    def updateThumbnailStrip(self):
+        '''Shows thumbnails spread across the recording being played back.
+        They are only redrawn when playback moves to another recording.'''
+        if self.player.segment==self.thumbnailSegment:
+            return
+        self.thumbnailSegment = self.player.segment
+        index = self.player.recordingSet.getIndex(self.thumbnailSegment)
+        frameNumbers = self.player.recordingSet.getThumbnailFrames(\
+            self.thumbnailSegment, self.numberOfThumbnails)
+        for (i, image) in enumerate(self.thumbnailImages):
+            if i < len(frameNumbers):
+                image.set_from_pixbuf(Playback.createThumbnail(\
+                    index.getFrameData(frameNumbers[i]), self.thumbnailHeight))
+            else:
+                image.clear()
   
     def incrementCamera(self):
         '''changes to the next camera in the rtspPipelineList and reinstates
@@ -180,11 +314,7 @@ class OperatorInterface:
         self.rtspPipeline.setCurrentCropProperties(\
             self.left[self.currentCamera], self.right[self.currentCamera],\
             self.top[self.currentCamera], self.bottom[self.currentCamera])
-        try:
-            self.rtspPipeline.videobalance.set_property('brightness', \
-                self.brightness[self.currentCamera])
-        except:
-            print('Cannot set brightness.  Maybe no videobalance element')
+        self.rtspPipeline.setBrightness(self.brightness[self.currentCamera])
         if self.pipelineType=='toFile':
             self.rtspPipeline.assignOutputFilename()
 
@@ -308,11 +438,8 @@ class OperatorInterface:
             self.deltaBrightness)):
             self.brightness[self.currentCamera] = \
                 self.brightness[self.currentCamera] + self.deltaBrightness
-            try:
-                self.rtspPipeline.videobalance.set_property('brightness', \
-                    self.brightness[self.currentCamera])
-            except:
-                print('Cannot set brightness.  Maybe no videobalance element')
+            self.rtspPipeline.setBrightness(\
+                self.brightness[self.currentCamera])
 
     def darken(self):
         '''Digitally unbrighten image'''
@@ -321,35 +448,34 @@ class OperatorInterface:
             self.deltaBrightness)):
             self.brightness[self.currentCamera] = \
                 self.brightness[self.currentCamera] - self.deltaBrightness
-            try:
-                self.rtspPipeline.videobalance.set_property('brightness', \
-                    self.brightness[self.currentCamera])
-            except:
-                print('Cannot set brightness.  Maybe no videobalance element')
+            self.rtspPipeline.setBrightness(\
+                self.brightness[self.currentCamera])
 
     def instantiateRtspPipeline(self):
         '''Danger'''
         if self.pipelineType=='simple':
             self.rtspPipeline = AxisRtsp.RtspPipelineSimple(\
                 self.ipAddressList[self.currentCamera], \
-                self.drawingArea.window.xid)
+                self.drawingArea.window.xid, self.decodeThreads)
         elif self.pipelineType=='lightenOnly':
             self.rtspPipeline = AxisRtsp.RtspPipelineLightenOnly(
                 self.ipAddressList[self.currentCamera], \
-                self.drawingArea.window.xid)
+                self.drawingArea.window.xid, self.decodeThreads)
         elif self.pipelineType=='toFileAndDisplay':
             self.rtspPipeline = AxisRtsp.RtspPipelineToFileAndDisplay(\
                 self.ipAddressList[self.currentCamera], \
-                self.drawingArea.window.xid)
+                self.drawingArea.window.xid, self.decodeThreads)
         elif self.pipelineType=='lightenPTZ':
-            self.rtspPipeline = AxisRtsp.RtspPipelineToDisplay(\
+            # crop, scale and balance are only switched in once used:
+            self.rtspPipeline = AxisRtsp.RtspPipelineBuilder(\
                 self.ipAddressList[self.currentCamera], \
-                self.drawingArea.window.xid)
+                self.drawingArea.window.xid, self.decodeThreads, crop=True, \
+                scale=True, balance=True)
         else:
             print('Unknown argument self.pipelineType=%s' % self.pipelineType)
             print('Using simple pipeline instead')
             AxisRtsp.RtspPipelineSimple(self.ipAddressList[self.currentCamera],\
-                self.drawingArea.window.xid)
+                self.drawingArea.window.xid, self.decodeThreads)
 
 def test1():
     '''One camera and no PTZ or brightening available'''